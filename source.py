@@ -5,24 +5,97 @@
 # - Automatic reprocessing if validator flags insufficient context
 # - Citation source tracing
 
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain.memory import ConversationBufferMemory
-from langgraph.graph import StateGraph, ParallelFor, END
-import redis
+from pydantic import BaseModel, PrivateAttr
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain_core.messages import AIMessage, SystemMessage, messages_to_dict
+from langgraph.graph import StateGraph, END
+import redis.asyncio as redis
+import httpx
+import asyncio
+import numpy as np
+import faiss
+import tiktoken
 import uuid
-import json
+import re
+import orjson
+import hashlib
+from typing import Any, TypedDict
+from functools import lru_cache
 import logging
-import requests
 import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 app = FastAPI()
-rdb = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
+redis_pool = redis.ConnectionPool(host="localhost", port=6379, db=0, decode_responses=True, max_connections=64)
+rdb = redis.Redis(connection_pool=redis_pool)
+# Blocking XREADs from WebSocket clients hold a connection each, so they get their own pool
+stream_rdb = redis.Redis(connection_pool=redis.BlockingConnectionPool(host="localhost", port=6379, db=0, decode_responses=True, max_connections=256, timeout=20))
+
+_httpx_limits = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+_shared_httpx = httpx.Client(limits=_httpx_limits)
+_shared_async_httpx = httpx.AsyncClient(limits=_httpx_limits)
+_mcp = httpx.AsyncClient(timeout=5.0, limits=httpx.Limits(max_keepalive_connections=20), http2=True)
+MCP_PUBMED_URL = "https://mcpdemo.fly.dev/api/context/pubmed"
+
+@lru_cache(maxsize=8)
+def get_llm(temperature, model="gpt-3.5-turbo", streaming=False):
+    # One client per (temperature, model, streaming) so every agent reuses the same keep-alive pool
+    return ChatOpenAI(temperature=temperature, model=model, streaming=streaming, http_client=_shared_httpx, http_async_client=_shared_async_httpx)
+
+# Strong references to in-flight pipelines so the event loop doesn't drop them
+background_jobs = set()
+
+# Sent before a re-synthesis: clients should discard the summary streamed so far
+STREAM_RESET = "[RESET]"
+STREAM_TTL = 3600
+
+class TokenStream:
+    # Synthesizer tokens for one session as a Redis stream, so any worker and any
+    # number of WebSocket clients can read (and replay) them
+    def __init__(self, rdb, session_id):
+        self.rdb = rdb
+        self.key = f"stream:{session_id}"
+
+    async def put(self, token):
+        if token:
+            await self.rdb.xadd(self.key, {"t": token})
+
+async def iter_tokens(session_id, block_ms=5000):
+    key = f"stream:{session_id}"
+    last_id = "0"
+    while True:
+        entries = await stream_rdb.xread({key: last_id}, count=100, block=block_ms)
+        if not entries:
+            if await rdb.hget(f"sess:{session_id}", "status") == "processing":
+                continue
+            # No stream (expired or unknown session): replay the stored summary once
+            final = await rdb.hget(f"sess:{session_id}", "final")
+            if final:
+                yield final
+            return
+        for entry_id, fields in entries[0][1]:
+            last_id = entry_id
+            if "end" in fields:
+                return
+            yield fields["t"]
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", question.strip().lower())
+
+async def fetch_mcp_context(query, ttl=3600):
+    key = "mcp:pubmed:" + hashlib.sha1(query.encode()).hexdigest()
+    cached = await rdb.get(key)
+    if cached is not None:
+        return cached
+    response = await _mcp.get(MCP_PUBMED_URL, params={"q": query})
+    if response.status_code != 200:
+        return None
+    await rdb.setex(key, ttl, response.text)
+    return response.text
 
 class QueryRequest(BaseModel):
     query: str
@@ -34,157 +107,393 @@ def get_mcp_context(session_id: str):
     # Deprecated placeholder endpoint
     return JSONResponse({"message": "This endpoint is no longer used. MCP context is fetched directly in node_validate."})
 
+@lru_cache(maxsize=4)
+def _encoding(model):
+    return tiktoken.encoding_for_model(model)
+
+def prune_to_tokens(messages, max_tokens=2000, max_summary_tokens=1000, model="gpt-3.5-turbo"):
+    # Keep the rolling summary (truncated to max_summary_tokens) plus the most recent
+    # buffer messages whose combined content fits in max_tokens
+    encoding = _encoding(model)
+    head = []
+    if messages and messages[0].type == "system":
+        summary_tokens = encoding.encode(messages[0].content)
+        if len(summary_tokens) > max_summary_tokens:
+            head = [SystemMessage(content=encoding.decode(summary_tokens[:max_summary_tokens]))]
+        else:
+            head = [messages[0]]
+        messages = messages[1:]
+    kept, total = [], 0
+    for m in reversed(messages):
+        total += len(encoding.encode(m.content))
+        if total > max_tokens:
+            break
+        kept.append(m)
+    return head + kept[::-1]
+
+class SummaryBufferMemory(ConversationSummaryBufferMemory):
+    # Bounded chat memory whose prompt-ready transcript is rebuilt only when the buffer or summary changes
+    _formatted: str = PrivateAttr(default=None)
+    _formatted_key: tuple = PrivateAttr(default=None)
+
+    def formatted(self):
+        # Any write (save_context, chat_memory.add_*_message, pruning) changes this key
+        key = (len(self.chat_memory.messages), self.moving_summary_buffer)
+        if key != self._formatted_key:
+            labels = {"human": "User", "ai": "AI", "system": "Summary"}
+            history = prune_to_tokens(self.load_memory_variables({})["history"])
+            self._formatted = "\n".join(f"{labels.get(m.type, m.type)}: {m.content.strip()}" for m in history)
+            self._formatted_key = key
+        return self._formatted
+
+class CachedLLM:
+    # Exact-match response cache for low-temperature (near-deterministic) calls
+    def __init__(self, llm, rdb, ttl=3600, max_temperature=0.5):
+        self.llm = llm
+        self.rdb = rdb
+        self.ttl = ttl
+        self.enabled = llm.temperature < max_temperature
+
+    def _key(self, prompt):
+        payload = orjson.dumps({"m": self.llm.model_name, "t": self.llm.temperature, "p": str(prompt)}, option=orjson.OPT_SORT_KEYS)
+        return "llm:" + hashlib.sha256(payload).hexdigest()
+
+    async def ainvoke(self, prompt):
+        if not self.enabled:
+            return await self.llm.ainvoke(prompt)
+        key = self._key(prompt)
+        # Count the lookup as a hit in the same round-trip; a miss moves it over with the SETEX
+        async with self.rdb.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.hincrby("llm:cache:stats", "hits", 1)
+            cached, _ = await pipe.execute()
+        if cached is not None:
+            return AIMessage(content=cached)
+        try:
+            result = await self.llm.ainvoke(prompt)
+        except Exception:
+            await self.rdb.hincrby("llm:cache:stats", "hits", -1)
+            raise
+        async with self.rdb.pipeline(transaction=False) as pipe:
+            pipe.setex(key, self.ttl, result.content)
+            pipe.hincrby("llm:cache:stats", "hits", -1)
+            pipe.hincrby("llm:cache:stats", "misses", 1)
+            await pipe.execute()
+        return result
+
+    def astream(self, prompt):
+        return self.llm.astream(prompt)
+
+def l2_normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype="float32"))
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+class TurnEmbeddings:
+    # Per-turn embedding memo so each distinct text is embedded at most once per query
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.vectors = {}
+
+    @staticmethod
+    def _key(text):
+        return hashlib.sha1(normalize_question(text).encode()).hexdigest()
+
+    async def embed_many(self, texts):
+        missing = list({self._key(t): t for t in texts if self._key(t) not in self.vectors}.items())
+        if missing:
+            vectors = l2_normalize(await self.embeddings.aembed_documents([t for _, t in missing]))
+            for (key, _), vector in zip(missing, vectors):
+                self.vectors[key] = vector
+
+    async def get_or_embed(self, text):
+        key = self._key(text)
+        if key not in self.vectors:
+            self.vectors[key] = l2_normalize(await self.embeddings.aembed_query(text))[0]
+        return self.vectors[key]
+
+class SemanticCache:
+    # Nearest-neighbour cache of (sub-question embedding -> response), persisted in Redis.
+    # The FAISS index is per process: with several workers, each one sees entries added by
+    # the others only after its next startup load.
+    def __init__(self, rdb, namespace="sem:retriever", dim=1536, ttl=7 * 24 * 3600, max_entries=10000):
+        self.rdb = rdb
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.index = faiss.IndexFlatIP(dim)
+        self.responses = []
+
+    async def load(self, batch_size=500):
+        keys = [key async for key in self.rdb.scan_iter(f"{self.namespace}:*", count=batch_size)]
+        for i in range(0, len(keys), batch_size):
+            for raw in await self.rdb.mget(keys[i:i + batch_size]):
+                if raw is not None:
+                    entry = orjson.loads(raw)
+                    self._insert(np.array(entry["v"], dtype="float32"), entry["r"])
+
+    def _insert(self, vector, response):
+        if self.index.ntotal >= self.max_entries:
+            # Drop the oldest tenth; IndexFlat compacts ids, so positions stay aligned
+            evict = max(1, self.max_entries // 10)
+            self.index.remove_ids(np.arange(evict, dtype="int64"))
+            del self.responses[:evict]
+        self.index.add(l2_normalize(vector))
+        self.responses.append(response)
+
+    async def lookup(self, text, embedder, threshold=0.92):
+        vector = await embedder.get_or_embed(text)
+        if self.index.ntotal == 0:
+            return None
+        scores, ids = self.index.search(vector[None, :], 1)
+        if scores[0][0] >= threshold:
+            return self.responses[ids[0][0]]
+        return None
+
+    async def add(self, text, response, embedder):
+        vector = await embedder.get_or_embed(text)
+        self._insert(vector, response)
+        digest = hashlib.sha1(normalize_question(text).encode()).hexdigest()
+        await self.rdb.setex(f"{self.namespace}:{digest}", self.ttl, orjson.dumps({"v": vector, "r": response}, option=orjson.OPT_SERIALIZE_NUMPY).decode())
+
+# Built on startup so importing the app needs neither Redis nor an OpenAI key
+embeddings = None
+semantic_cache = None
+
+@app.on_event("startup")
+async def init_semantic_cache():
+    global embeddings, semantic_cache
+    embeddings = OpenAIEmbeddings(model="text-embedding-3-small", http_client=_shared_httpx, http_async_client=_shared_async_httpx)
+    semantic_cache = SemanticCache(rdb)
+    await semantic_cache.load()
+
 class RetrieverAgent:
-    def __init__(self, llm, memory):
-        self.prompt = PromptTemplate(
-            input_variables=["subquestion", "chat_history"],
-            template="Here is the prior conversation context:\n{chat_history}\n\nNow answer the following sub-question in 2 sentences:\n{subquestion}"
-        )
+    def __init__(self, llm, memory, cache=None, embedder=None):
+        self.prompt = lambda subquestion, chat_history: f"Answer the sub-question at the end in 2 sentences, using the prior conversation context where relevant.\n\nPrior conversation context:\n{chat_history}\n\nSub-question:\n{subquestion}"
         self.llm = llm
         self.memory = memory
+        self.cache = cache
+        self.embedder = embedder
 
-    def run(self, subquestion):
-        chat_history = "\n".join([f"User: {m.content}" if m.type == 'human' else f"AI: {m.content}" for m in self.memory.chat_memory.messages])
-        result = self.llm.invoke(self.prompt.format(subquestion=subquestion, chat_history=chat_history)).content.strip()
-        self.memory.chat_memory.add_user_message(subquestion)
-        self.memory.chat_memory.add_ai_message(result)
+    async def run(self, subquestion):
+        result = await self.cache.lookup(subquestion, self.embedder) if self.cache else None
+        if result is not None:
+            logger.info(f"RetrieverAgent semantic cache hit for '{subquestion}'")
+        else:
+            chat_history = self.memory.formatted()
+            result = (await self.llm.ainvoke(self.prompt(subquestion=subquestion, chat_history=chat_history))).content.strip()
+            if self.cache:
+                await self.cache.add(subquestion, result, self.embedder)
         logger.info(f"RetrieverAgent response for '{subquestion}': {result}")
         return result
 
 class SynthesizerAgent:
     def __init__(self, llm, memory):
-        self.prompt = PromptTemplate(
-            input_variables=["responses", "chat_history"],
-            template="Here is the prior conversation:\n{chat_history}\n\nGiven these pieces of information:\n{responses}\n\nSummarize the key insight in 3 sentences."
-        )
+        self.prompt = lambda responses, chat_history: f"Summarize the key insight of the information at the end in 3 sentences, taking the prior conversation into account.\n\nPrior conversation:\n{chat_history}\n\nInformation:\n{responses}"
         self.llm = llm
         self.memory = memory
 
-    def run(self, responses):
-        chat_history = "\n".join([f"User: {m.content}" if m.type == 'human' else f"AI: {m.content}" for m in self.memory.chat_memory.messages])
-        return self.llm.invoke(self.prompt.format(responses=responses, chat_history=chat_history)).content.strip()
+    async def run(self, responses, queue=None):
+        chat_history = self.memory.formatted()
+        prompt = self.prompt(responses=responses, chat_history=chat_history)
+        if queue is None:
+            return (await self.llm.ainvoke(prompt)).content.strip()
+        tokens = []
+        async for chunk in self.llm.astream(prompt):
+            tokens.append(chunk.content)
+            await queue.put(chunk.content)
+        return "".join(tokens).strip()
 
 class ValidatorAgent:
     def __init__(self, llm):
-        self.prompt = PromptTemplate(
-            input_variables=["summary", "query"],
-            template="Does this summary properly answer the question?\n\nQuestion: {query}\n\nSummary: {summary}\n\nAnswer yes or no and explain briefly."
-        )
+        self.prompt = lambda summary, query: f"Does the summary below properly answer the question? Answer yes or no and explain briefly.\n\nQuestion: {query}\n\nSummary: {summary}"
         self.llm = llm
 
-    def run(self, query, summary):
-        return self.llm.invoke(self.prompt.format(query=query, summary=summary)).content.strip()
+    async def run(self, query, summary):
+        return (await self.llm.ainvoke(self.prompt(query=query, summary=summary))).content.strip()
 
 class ExplainerAgent:
     def __init__(self, llm, memory):
-        self.prompt = PromptTemplate(
-            input_variables=["summary", "chat_history"],
-            template="Here is the chat history:\n{chat_history}\n\nExplain this summary in more detail for a technical audience:\n{summary}"
-        )
+        self.prompt = lambda summary, chat_history: f"Explain the summary at the end in more detail for a technical audience, using the chat history for context.\n\nChat history:\n{chat_history}\n\nSummary:\n{summary}"
         self.llm = llm
         self.memory = memory
 
-    def run(self, summary):
-        chat_history = "\n".join([f"User: {m.content}" if m.type == 'human' else f"AI: {m.content}" for m in self.memory.chat_memory.messages])
-        return self.llm.invoke(self.prompt.format(summary=summary, chat_history=chat_history)).content.strip()
+    async def run(self, summary):
+        chat_history = self.memory.formatted()
+        return (await self.llm.ainvoke(self.prompt(summary=summary, chat_history=chat_history))).content.strip()
 
-@app.post("/query")
-def handle_query(req: QueryRequest, background_tasks: BackgroundTasks):
-    session_id = req.session_id or str(uuid.uuid4())
-    rdb.set(f"status:{session_id}", "processing")
-
-    memory = ConversationBufferMemory(return_messages=True)
-    decomposer = lambda state: {"subquestions": [f"Sub-question 1 from: {state['query']}"]}  # Simplified example
-    retriever = RetrieverAgent(ChatOpenAI(temperature=0.0), memory)
-    synthesizer = SynthesizerAgent(ChatOpenAI(temperature=0.7), memory)
-    validator = ValidatorAgent(ChatOpenAI(temperature=0.2))
-    explainer = ExplainerAgent(ChatOpenAI(temperature=0.6), memory)
-
-    def node_decompose(state):
-        return decomposer(state)
-
-    def retrieve_one(state):
-        subq = state["subquestion"]
-        return {"response": f"Q: {subq}\nA: {retriever.run(subq)}"}
-
-    def node_summarize(state):
-        summary = synthesizer.run("\n\n".join(state["responses"]))
-        cited_chunk = state.get("api_context") or state.get("doc_context") or "[No citation available]"
-        cited_chunk = cited_chunk[:300] + "..." if cited_chunk else "[No citation]"
-        state["citation"] = cited_chunk
-        return {"final": summary, "citation": cited_chunk}
-
-    def node_validate(state):
-        verdict = validator.run(state["query"], state["final"])
-        if "need more context" in verdict.lower():
-            try:
-                logger.info("Validator indicates context is insufficient. Fetching from public MCP server...")
-                response = requests.get("https://mcpdemo.fly.dev/api/context/pubmed", params={"q": state["query"]})
-                if response.status_code == 200:
-                    external_context = response.text
-                    rdb.set(f"context:api:{state.get('session_id', 'unknown')}", external_context)
-                    enhanced_responses = [
-                        f"Q: {q}\nA: {RetrieverAgent(ChatOpenAI(temperature=0.0), memory).run(q)}"
-                        for q in state["subquestions"]
-                    ]
-                    summary = SynthesizerAgent(ChatOpenAI(temperature=0.7), memory).run("\n\n".join(enhanced_responses))
-                    verdict = validator.run(state["query"], summary)
-                    state["final"] = summary
-                    state["responses"] = enhanced_responses
-            except Exception as e:
-                logger.warning(f"Failed to enrich with external API context: {e}")
-        return {"verdict": verdict}
-
-    def node_explain(state):
-        return {"explanation": explainer.run(state["final"])}
-
-    builder = StateGraph()
+decomposer = lambda state: {"subquestions": [f"Sub-question 1 from: {state['query']}"]}  # Simplified example
+
+class SessionState(TypedDict, total=False):
+    query: str
+    session_id: str
+    doc_context: str
+    api_context: str
+    subquestions: list
+    all_subquestions: list
+    responses: list
+    final: str
+    citation: str
+    verdict: str
+    explanation: str
+    # Per-session objects, stripped before the result is stored
+    _embeddings: Any
+    _retriever: Any
+    _synthesizer: Any
+    _validator: Any
+    _explainer: Any
+    _token_stream: Any
+
+# Graph nodes are module-level; per-session agents travel in the "_"-prefixed state keys
+async def node_decompose(state):
+    subquestions = decomposer(state)["subquestions"]
+    unique = {}
+    for q in subquestions:
+        unique.setdefault(normalize_question(q), q)
+    unique = list(unique.values())
+    await state["_embeddings"].embed_many(unique)
+    return {"subquestions": unique, "all_subquestions": subquestions}
+
+async def node_retrieve(state):
+    retriever = state["_retriever"]
+    answers = await asyncio.gather(*(retriever.run(q) for q in state["subquestions"]))
+    # Memory writes (and the summariser's prune) run one at a time, in sub-question order
+    for q, a in zip(state["subquestions"], answers):
+        await retriever.memory.asave_context({"input": q}, {"output": a})
+    by_question = {normalize_question(q): f"Q: {q}\nA: {a}" for q, a in zip(state["subquestions"], answers)}
+    return {"responses": [by_question[normalize_question(q)] for q in state["all_subquestions"]]}
+
+async def node_summarize(state):
+    summary = await state["_synthesizer"].run("\n\n".join(state["responses"]), state["_token_stream"])
+    cited_chunk = state.get("api_context") or state.get("doc_context") or "[No citation available]"
+    cited_chunk = cited_chunk[:300] + "..." if cited_chunk else "[No citation]"
+    return {"final": summary, "citation": cited_chunk}
+
+async def node_validate(state):
+    validator = state["_validator"]
+    verdict = await validator.run(state["query"], state["final"])
+    update = {}
+    reset_sent = False
+    if "need more context" in verdict.lower():
+        try:
+            logger.info("Validator indicates context is insufficient. Fetching from public MCP server...")
+            external_context = await fetch_mcp_context(state["query"])
+            if external_context is not None:
+                await rdb.set(f"context:api:{state.get('session_id', 'unknown')}", external_context)
+                # Prior sub-answers are still valid; only the external context is new
+                augmented = state["responses"] + [f"External: {external_context[:1500]}"]
+                await state["_token_stream"].put(STREAM_RESET)
+                reset_sent = True
+                summary = await state["_synthesizer"].run("\n\n".join(augmented), state["_token_stream"])
+                verdict = await validator.run(state["query"], summary)
+                update = {"final": summary, "responses": augmented}
+        except Exception as e:
+            logger.warning(f"Failed to enrich with external API context: {e}")
+            if reset_sent:
+                # Clients dropped the first summary on the reset; stream it again since it stands
+                await state["_token_stream"].put(STREAM_RESET)
+                await state["_token_stream"].put(state["final"])
+    return {"verdict": verdict, **update}
+
+async def node_explain(state):
+    return {"explanation": await state["_explainer"].run(state["final"])}
+
+def build_graph():
+    builder = StateGraph(SessionState)
     builder.add_node("decompose", node_decompose)
+    builder.add_node("retrieve", node_retrieve)
     builder.add_node("synthesize", node_summarize)
     builder.add_node("validate", node_validate)
     builder.add_node("explain", node_explain)
 
-    parallel = ParallelFor("subquestions")
-    parallel.add_node("retrieve_one", retrieve_one)
-    parallel.set_entry_point("retrieve_one")
-    parallel.add_edge("retrieve_one", END)
-    builder.add_node("retrieve", parallel)
-
     builder.set_entry_point("decompose")
     builder.add_edge("decompose", "retrieve")
     builder.add_edge("retrieve", "synthesize")
     builder.add_edge("synthesize", "validate")
-    builder.add_edge("validate", "explain")
+    builder.add_conditional_edges(
+        "validate",
+        lambda state: "explain" if state["verdict"].lower().startswith("yes") else END,
+        {"explain": "explain", END: END}
+    )
     builder.add_edge("explain", END)
+    return builder.compile()
+
+GRAPH = build_graph()
+
+@app.post("/query")
+async def handle_query(req: QueryRequest):
+    session_id = req.session_id or str(uuid.uuid4())
+    token_stream = TokenStream(rdb, session_id)
+    async with rdb.pipeline(transaction=False) as pipe:
+        pipe.hset(f"sess:{session_id}", "status", "processing")
+        pipe.delete(token_stream.key)
+        await pipe.execute()
 
-    graph = builder.compile()
+    memory = SummaryBufferMemory(llm=get_llm(0.0), max_token_limit=400, return_messages=True)
+    turn_embeddings = TurnEmbeddings(embeddings)
 
-    def process_query():
-        initial_state = {"query": req.query, "session_id": session_id, "doc_context": req.paper_url}
-        result = graph.invoke(initial_state)
-        memory_json = json.dumps(memory.load_memory_variables({}))
-        rdb.set(f"result:{session_id}", json.dumps({
-            "state_transitions": result,
-            "output": result,
-            "memory": memory_json
-        }))
-        rdb.set(f"status:{session_id}", "complete")
+    async def process_query():
+        initial_state = {
+            "query": req.query,
+            "session_id": session_id,
+            "doc_context": req.paper_url,
+            "_embeddings": turn_embeddings,
+            "_retriever": RetrieverAgent(CachedLLM(get_llm(0.0), rdb), memory, semantic_cache, turn_embeddings),
+            "_synthesizer": SynthesizerAgent(CachedLLM(get_llm(0.7, streaming=True), rdb), memory),
+            "_validator": ValidatorAgent(CachedLLM(get_llm(0.2), rdb)),
+            "_explainer": ExplainerAgent(CachedLLM(get_llm(0.6), rdb), memory),
+            "_token_stream": token_stream,
+        }
+        try:
+            result = await GRAPH.ainvoke(initial_state)
+            output = {k: v for k, v in result.items() if not k.startswith("_")}
+            memory_trace = {"history": messages_to_dict(memory.load_memory_variables({})["history"])}
+            # Small fields stay separate so status polls never parse the full state
+            session = {
+                "status": "complete",
+                "final": output.get("final", ""),
+                "citation": output.get("citation", ""),
+                "output": orjson.dumps(output).decode(),
+                "memory": orjson.dumps(memory_trace).decode()
+            }
+        except Exception as e:
+            logger.exception(f"Pipeline failed for session {session_id}: {e}")
+            session = {"status": "error"}
+        # Status and end-of-stream land atomically, so readers never see one without the other
+        async with rdb.pipeline(transaction=True) as pipe:
+            pipe.hset(f"sess:{session_id}", mapping=session)
+            pipe.xadd(token_stream.key, {"end": "1"})
+            pipe.expire(token_stream.key, STREAM_TTL)
+            await pipe.execute()
 
-    background_tasks.add_task(process_query)
-    return {"message": "Processing started.", "session_id": session_id, "status_url": f"/session/{session_id}/status"}
+    task = asyncio.create_task(process_query())
+    background_jobs.add(task)
+    task.add_done_callback(background_jobs.discard)
+    return {"message": "Processing started.", "session_id": session_id, "status_url": f"/session/{session_id}/status", "stream_url": f"/ws/{session_id}"}
 
 @app.get("/session/{session_id}/status")
-def get_result(session_id: str):
-    status = rdb.get(f"status:{session_id}")
-    if not status:
+async def get_result(session_id: str, full: bool = False):
+    fields = ["status", "final", "citation"] + (["output", "memory"] if full else [])
+    session = dict(zip(fields, await rdb.hmget(f"sess:{session_id}", fields)))
+    if not session["status"]:
         return {"error": "Session not found"}
-    if status == "processing":
-        return {"status": "processing"}
-    result = rdb.get(f"result:{session_id}")
-    full_data = json.loads(result)
+    if session["status"] in ("processing", "error"):
+        return {"status": session["status"]}
+    if not full:
+        return {"status": "complete", "result": {"final": session["final"]}, "citation": session["citation"]}
     return {
         "status": "complete",
-        "result": full_data.get("output", {}),
-        "memory_trace": full_data.get("memory", {}),
-        "citation": full_data.get("output", {}).get("citation", "")
+        "result": orjson.loads(session["output"]),
+        "memory_trace": orjson.loads(session["memory"]),
+        "citation": session["citation"]
     }
+
+@app.websocket("/ws/{session_id}")
+async def stream_session(websocket: WebSocket, session_id: str):
+    await websocket.accept()
+    try:
+        async for token in iter_tokens(session_id):
+            await websocket.send_text(token)
+    except WebSocketDisconnect:
+        logger.info(f"WebSocket client for session {session_id} disconnected")
+        return
+    await websocket.close()